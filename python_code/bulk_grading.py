@@ -0,0 +1,705 @@
+"""
+===========================================================
+DEFERRED BULK GRADING
+-----------------------------------------------------------
+• For non-urgent re-grades of the `answers` table
+• Exports rows to a JSONL batch request file
+• Submits through a provider batch endpoint, or runs a
+  throttled local stand-in against the normal client
+• Ingests the result file back into the DB in chunks
+• Resumable: every step checkpoints to <file>.state.json
+• Reports batch throughput next to the interactive worker
+===========================================================
+
+Usage:
+    python bulk_grading.py --init
+    python bulk_grading.py export term.jsonl [--regrade | --stale] [--limit N]
+    python bulk_grading.py submit term.jsonl [--local]
+    python bulk_grading.py poll term.jsonl
+    python bulk_grading.py ingest term.jsonl
+    python bulk_grading.py report term.jsonl
+    python bulk_grading.py release term.jsonl
+    python bulk_grading.py run term.jsonl [--local] [--regrade | --stale]
+"""
+
+import os
+import json
+import time
+import uuid
+import argparse
+from datetime import datetime
+
+from dotenv import load_dotenv
+from openai import OpenAI
+from psycopg2.extras import execute_values
+
+from evaluation_agent_parallel import (
+    client, breaker, get_conn, build_request, parse_output,
+    SLEEP_BETWEEN_EVALS, SLEEP_BETWEEN_CYCLES
+)
+from circuit_breaker import ProviderUnavailable
+from score_aggregates import record_scores, student_column
+from lexical_scorer import triage, breakdown_result, lexical_fingerprint
+from grading_fingerprint import request_fingerprint
+from regrade_planner import fresh_fingerprints
+
+# =========================================================
+# CONFIG
+# =========================================================
+load_dotenv()
+
+# Provider with a batch endpoint (OpenAI-compatible Files + Batches API).
+# Without it, use --local. BULK_MODEL must name a model that
+# provider serves; the sonar-pro default only suits --local.
+BATCH_API_KEY = os.getenv("BATCH_API_KEY") or os.getenv("OPENAI_API_KEY")
+BATCH_BASE_URL = os.getenv("BATCH_BASE_URL")  # None → api.openai.com
+BULK_MODEL = os.getenv("BULK_MODEL") or "sonar-pro"
+BULK_FINGERPRINT = request_fingerprint(build_request("", "", model=BULK_MODEL))
+
+EXPORT_PAGE_SIZE = 1000
+INGEST_CHUNK_SIZE = 500
+POLL_INTERVAL = 60
+LOCAL_SLEEP = float(os.getenv("BULK_LOCAL_SLEEP", SLEEP_BETWEEN_EVALS))
+
+CUSTOM_ID_PREFIX = "answer-"
+
+# Error lines caused by the provider, not by the row: released
+# without a retry_count bump, like the interactive worker does
+OUTAGE_STATUS_CODES = {401, 403, 408, 429}
+OUTAGE_ERROR_CODES = {
+    "batch_expired", "batch_cancelled", "server_error",
+    "rate_limit_exceeded", "insufficient_quota",
+}
+
+MIGRATION_SQL = """
+ALTER TABLE answers ADD COLUMN IF NOT EXISTS bulk_job TEXT;
+"""
+
+# =========================================================
+# CHECKPOINT STATE
+# =========================================================
+def state_path(request_file):
+    return request_file + ".state.json"
+
+def results_path(request_file):
+    return request_file + ".results.jsonl"
+
+def load_state(request_file):
+    path = state_path(request_file)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(request_file, state):
+    # Write-then-rename so a crash never leaves a torn checkpoint
+    path = state_path(request_file)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+def now_iso():
+    return datetime.utcnow().isoformat()
+
+# =========================================================
+# EXPORT
+# =========================================================
+def export_requests(request_file, regrade=False, limit=None, stale_only=False):
+    """
+    Move pending/failed rows to status 'batched' (so live
+    workers leave them alone) and write one request line per
+    row. With regrade=True, evaluated rows are included too
+    but keep their status and current score until ingest;
+    stale_only=True narrows that to the rows the re-grade
+    planner counts as stale.
+    Blank answers (the only rows the local scorer can settle
+    without a reference answer) are graded here and never
+    reach the request file.
+
+    Every claimed row is tagged with this job's id (bulk_job).
+    Checkpoints after every page; a rerun truncates the file to
+    the last checkpoint and picks up this job's 'batched' rows
+    of the interrupted page again, never another job's.
+    """
+    state = load_state(request_file)
+    if state.get("exported_at"):
+        print(f"⏭ Already exported {state['exported']} rows")
+        return state
+
+    statuses = ["pending", "failed"] + (["evaluated"] if regrade and not stale_only else [])
+    # Evaluated rows whose stamp is not in this set are re-graded
+    fresh = fresh_fingerprints("answers") if stale_only else None
+    state.setdefault("job_id", uuid.uuid4().hex)
+    state.setdefault("export_started_at", now_iso())
+    # Fixed at export: results are stamped with the rubric the
+    # request file was built from, even if it changes before ingest
+    state.setdefault("fingerprint", BULK_FINGERPRINT)
+    # Saved before the first claim, so 'release' can always find
+    # rows tagged with this job even if the first page dies
+    save_state(request_file, state)
+    exported = state.get("exported", 0)
+    triaged = state.get("triaged_locally", 0)
+    last_id = state.get("export_last_id")
+
+    mode = "r+" if os.path.exists(request_file) and last_id is not None else "w"
+    with open(request_file, mode) as out:
+        out.seek(state.get("export_bytes", 0))
+        out.truncate()
+
+        while limit is None or exported < limit:
+            page = EXPORT_PAGE_SIZE if limit is None else min(EXPORT_PAGE_SIZE, limit - exported)
+
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        UPDATE answers
+                        SET status = CASE WHEN status = 'evaluated' THEN status ELSE 'batched' END,
+                            bulk_job = %s
+                        WHERE id IN (
+                            SELECT id
+                            FROM answers
+                            WHERE (status = ANY(%s)
+                                   OR (%s::text[] IS NOT NULL
+                                       AND status = 'evaluated'
+                                       AND NOT (coalesce(grading_fingerprint, '') = ANY(%s)))
+                                   OR (status = 'batched' AND bulk_job = %s))
+                              AND (%s IS NULL OR id > %s)
+                            ORDER BY id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, question, answer;
+                        """,
+                        (state["job_id"], statuses, fresh, fresh, state["job_id"], last_id, last_id, page)
+                    )
+                    rows = sorted(cur.fetchall())
+
+            if not rows:
+                break
+
+            batch = [
+                {"id": r[0], "question": r[1], "answer": r[2]}
+                for r in rows
+            ]
+            # No reference answer in answers: only blanks qualify
+            provisional = triage(batch)
+
+            local_results = []
+            for ans, local in zip(batch, provisional):
+                if local is not None:
+                    local_results.append((ans["id"], breakdown_result(local)))
+                    continue
+                out.write(json.dumps({
+                    "custom_id": f"{CUSTOM_ID_PREFIX}{ans['id']}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": build_request(ans["question"], ans["answer"], model=BULK_MODEL),
+                }) + "\n")
+
+            if local_results:
+                apply_results(local_results, [], lexical_fingerprint(state["fingerprint"]))
+                triaged += len(local_results)
+
+            exported += len(batch) - len(local_results)
+            last_id = batch[-1]["id"]
+
+            out.flush()
+            state.update({
+                "exported": exported,
+                "triaged_locally": triaged,
+                "export_last_id": last_id,
+                "export_bytes": out.tell(),
+            })
+            save_state(request_file, state)
+            print(f"📤 Exported {exported} rows ({triaged} graded locally)")
+
+    state.update({
+        "request_file": request_file,
+        "regrade": regrade,
+        "stale_only": stale_only,
+        "exported_at": now_iso(),
+    })
+    save_state(request_file, state)
+    return state
+
+# =========================================================
+# SUBMIT / POLL (PROVIDER BATCH ENDPOINT)
+# =========================================================
+def check_batch_config():
+    """
+    Fail before any row is claimed when the batch endpoint
+    cannot serve BULK_MODEL; otherwise every line would error
+    and every row would come back failed.
+    """
+    if not BATCH_API_KEY:
+        raise ValueError("BATCH_API_KEY / OPENAI_API_KEY not set; use --local")
+    if not os.getenv("BULK_MODEL"):
+        raise ValueError("Set BULK_MODEL to a model the batch provider serves, or use --local")
+    if not BATCH_BASE_URL and BULK_MODEL.startswith("sonar"):
+        raise ValueError(f"{BULK_MODEL} is a Perplexity model; api.openai.com cannot serve it")
+
+def batch_client():
+    check_batch_config()
+    return OpenAI(api_key=BATCH_API_KEY, base_url=BATCH_BASE_URL)
+
+def submit_batch(request_file):
+    state = load_state(request_file)
+    if state.get("batch_id"):
+        print(f"⏭ Already submitted as {state['batch_id']}")
+        return state
+
+    bc = batch_client()
+    with open(request_file, "rb") as f:
+        uploaded = bc.files.create(file=f, purpose="batch")
+
+    batch = bc.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+    state.update({"batch_id": batch.id, "submitted_at": now_iso()})
+    save_state(request_file, state)
+    print(f"🚚 Submitted batch {batch.id}")
+    return state
+
+def poll_batch(request_file, wait=True):
+    state = load_state(request_file)
+    if state.get("completed_at"):
+        return state
+
+    bc = batch_client()
+    while True:
+        batch = bc.batches.retrieve(state["batch_id"])
+        print(f"⏳ Batch {batch.id}: {batch.status}")
+
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        if not wait:
+            return state
+        time.sleep(POLL_INTERVAL)
+
+    # Results and per-request errors land in separate files; an
+    # expired or cancelled batch still has its partial output
+    with open(results_path(request_file), "w") as out:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text = bc.files.content(file_id).text
+                out.write(text if text.endswith("\n") else text + "\n")
+
+    state["completed_at"] = now_iso()
+    state["batch_status"] = batch.status
+    save_state(request_file, state)
+
+    if batch.status != "completed":
+        print(f"⚠️ Batch {batch.id} ended {batch.status}; ingesting partial output")
+        ingest_results(request_file)
+        release_rows(request_file)
+
+    return state
+
+# =========================================================
+# LOCAL STAND-IN
+# =========================================================
+def run_local(request_file):
+    """
+    Work through the request file with the normal client and
+    write results in the provider's batch output format.
+    Throttled by BULK_LOCAL_SLEEP and resumable: requests
+    already in the results file are skipped. Waits while the
+    provider circuit is open instead of recording errors.
+    """
+    state = load_state(request_file)
+    if state.get("completed_at"):
+        return state
+
+    out_path = results_path(request_file)
+    done = set()
+    if os.path.exists(out_path):
+        with open(out_path) as f:
+            done = {json.loads(line)["custom_id"] for line in f if line.strip()}
+
+    state.setdefault("submitted_at", now_iso())
+    state["batch_id"] = "local"
+    save_state(request_file, state)
+
+    with open(request_file) as f, open(out_path, "a") as out:
+        for line in f:
+            req = json.loads(line)
+            if req["custom_id"] in done:
+                continue
+
+            record = None
+            while record is None:
+                if breaker.acquire() is None:
+                    print("⏸ Provider circuit open. Waiting...")
+                    time.sleep(SLEEP_BETWEEN_CYCLES)
+                    continue
+
+                try:
+                    response = breaker.call(client.chat.completions.create, **req["body"])
+                    record = {
+                        "custom_id": req["custom_id"],
+                        "response": {"status_code": 200, "body": response.model_dump()},
+                        "error": None,
+                    }
+                except ProviderUnavailable as e:
+                    # Outage: retry this request rather than record an error
+                    print(f"⏸ Provider unavailable → {e}")
+                    time.sleep(SLEEP_BETWEEN_CYCLES)
+                except Exception as e:
+                    record = {
+                        "custom_id": req["custom_id"],
+                        "response": None,
+                        "error": {"message": str(e)[:200]},
+                    }
+
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            time.sleep(LOCAL_SLEEP)
+
+    state["completed_at"] = now_iso()
+    save_state(request_file, state)
+    return state
+
+# =========================================================
+# INGEST
+# =========================================================
+def is_outage(record):
+    response = record.get("response") or {}
+    status = response.get("status_code")
+    error = record.get("error") or {}
+    body_error = (response.get("body") or {}).get("error") or {}
+    codes = {error.get("code"), body_error.get("code")}
+    return (
+        (status is not None and (status in OUTAGE_STATUS_CODES or status >= 500))
+        or bool(codes & OUTAGE_ERROR_CODES)
+    )
+
+def parse_result_line(record):
+    """
+    (answer_id, result, outage): result is None for an error
+    line, and outage tells whether the provider caused it.
+    """
+    answer_id = int(record["custom_id"][len(CUSTOM_ID_PREFIX):])
+    response = record.get("response") or {}
+
+    if record.get("error") or response.get("status_code") != 200:
+        return answer_id, None, is_outage(record)
+
+    try:
+        raw = response["body"]["choices"][0]["message"]["content"]
+        result = parse_output(raw)
+        return answer_id, {
+            "total_score": float(result["total_score"]),
+            "content_score": float(result["content_score"]),
+            "organization_score": float(result["organization_score"]),
+            "language_score": float(result["language_score"]),
+            "grade": result["grade"],
+            "feedback": result["feedback"],
+        }, False
+    except Exception:
+        return answer_id, None, False
+
+def apply_results(successes, failures, fingerprint, released=()):
+    """
+    Write one chunk of results in a single transaction.
+    Summaries take back the old score of regraded rows and add
+    the new one. Failed 'batched' rows return to the
+    interactive pool as 'failed'; rows lost to a provider
+    outage (released) go back to 'pending' without a retry.
+    Failed regrades keep their previous grade.
+    """
+    ids = [i for i, _ in successes] + list(failures) + list(released)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT id, status, total_score, evaluated_at, question, {student_column("answers")}
+                FROM answers
+                WHERE id = ANY(%s)
+                FOR UPDATE;
+                """,
+                (ids,)
+            )
+            current = {r[0]: r for r in cur.fetchall()}
+
+            rows = []
+            score_deltas = []
+            evaluated_at = datetime.utcnow()
+            for answer_id, result in successes:
+                row = current.get(answer_id)
+                if row is None or row[1] not in ("batched", "evaluated"):
+                    continue
+                _, status, old_score, old_evaluated_at, question, student = row
+                if old_evaluated_at is not None and old_score is not None:
+                    score_deltas.append(("answers", question, student, old_score, -1))
+                score_deltas.append(("answers", question, student, result["total_score"], 1))
+                rows.append((
+                    answer_id,
+                    result["total_score"],
+                    result["content_score"],
+                    result["organization_score"],
+                    result["language_score"],
+                    result["grade"],
+                    result["feedback"],
+                    evaluated_at,
+                    fingerprint,
+                ))
+
+            if rows:
+                execute_values(
+                    cur,
+                    """
+                    UPDATE answers AS a
+                    SET status = 'evaluated',
+                        total_score = v.total_score::double precision,
+                        content_score = v.content_score::double precision,
+                        organization_score = v.organization_score::double precision,
+                        language_score = v.language_score::double precision,
+                        grade = v.grade,
+                        feedback = v.feedback,
+                        evaluated_at = v.evaluated_at,
+                        grading_fingerprint = v.grading_fingerprint,
+                        bulk_job = NULL
+                    FROM (VALUES %s) AS v(
+                        id, total_score, content_score, organization_score,
+                        language_score, grade, feedback, evaluated_at,
+                        grading_fingerprint
+                    )
+                    WHERE a.id = v.id;
+                    """,
+                    rows,
+                    page_size=INGEST_CHUNK_SIZE,
+                )
+                record_scores(cur, score_deltas)
+
+            if failures:
+                cur.execute(
+                    """
+                    UPDATE answers
+                    SET status = 'failed',
+                        retry_count = retry_count + 1,
+                        bulk_job = NULL
+                    WHERE id = ANY(%s)
+                      AND status = 'batched';
+                    """,
+                    (list(failures),)
+                )
+
+            if released:
+                cur.execute(
+                    """
+                    UPDATE answers
+                    SET status = 'pending',
+                        bulk_job = NULL
+                    WHERE id = ANY(%s)
+                      AND status = 'batched';
+                    """,
+                    (list(released),)
+                )
+
+    return len(rows), len(failures), len(released)
+
+def ingest_results(request_file):
+    """
+    Apply the results file in INGEST_CHUNK_SIZE chunks, saving
+    the line offset after each committed chunk so an
+    interrupted ingest resumes where it stopped. Malformed
+    lines are logged and skipped; their rows stay 'batched'
+    until 'release' hands them back.
+    """
+    state = load_state(request_file)
+    if state.get("ingested_at"):
+        print(f"⏭ Already ingested {state.get('ingested_ok', 0)} rows")
+        return state
+
+    offset = state.get("ingest_offset", 0)
+    state.setdefault("ingest_started_at", now_iso())
+
+    with open(results_path(request_file)) as f:
+        lines = [line for line in f if line.strip()]
+
+    while offset < len(lines):
+        chunk = lines[offset:offset + INGEST_CHUNK_SIZE]
+        successes, failures, released = [], [], []
+        malformed = 0
+        for line in chunk:
+            try:
+                answer_id, result, outage = parse_result_line(json.loads(line))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                malformed += 1
+                print(f"⚠️ Skipped malformed result line → {e}: {line[:120]!r}")
+                continue
+            if result is not None:
+                successes.append((answer_id, result))
+            elif outage:
+                released.append(answer_id)
+            else:
+                failures.append(answer_id)
+
+        ok, failed, back = apply_results(successes, failures, state["fingerprint"], released)
+
+        offset += len(chunk)
+        state["ingest_offset"] = offset
+        state["ingested_ok"] = state.get("ingested_ok", 0) + ok
+        state["ingested_failed"] = state.get("ingested_failed", 0) + failed
+        state["ingested_released"] = state.get("ingested_released", 0) + back
+        state["ingested_malformed"] = state.get("ingested_malformed", 0) + malformed
+        save_state(request_file, state)
+        print(f"📥 Ingested {offset}/{len(lines)} result lines")
+
+    if state.get("ingested_malformed"):
+        print(f"⚠️ {state['ingested_malformed']} malformed lines; run 'release' to requeue their rows")
+
+    state["ingested_at"] = now_iso()
+    save_state(request_file, state)
+    return state
+
+# =========================================================
+# RELEASE
+# =========================================================
+def release_rows(request_file):
+    """
+    Hand this job's remaining 'batched' rows back to the live
+    workers as 'pending' (no retry bump). Used after a batch
+    fails, expires or is cancelled, or to abandon a job.
+    """
+    state = load_state(request_file)
+    if not state.get("job_id"):
+        print("Nothing exported for this file")
+        return 0
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE answers
+                SET status = 'pending',
+                    bulk_job = NULL
+                WHERE status = 'batched'
+                  AND bulk_job = %s;
+                """,
+                (state["job_id"],)
+            )
+            released = cur.rowcount
+
+    state["released"] = state.get("released", 0) + released
+    state["released_at"] = now_iso()
+    save_state(request_file, state)
+    print(f"↩ Released {released} rows back to pending")
+    return released
+
+def init_schema():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(MIGRATION_SQL)
+
+    print("✅ bulk_job column ready")
+
+# =========================================================
+# THROUGHPUT REPORT
+# =========================================================
+def _seconds(start, end):
+    return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+
+def throughput_report(request_file):
+    """
+    Rows/hour for this batch (export → ingest) next to the
+    interactive worker's rows/hour over the same window,
+    measured from evaluated_at of rows not in this batch.
+    """
+    state = load_state(request_file)
+    if not state.get("ingested_at"):
+        raise ValueError("Batch not ingested yet")
+
+    with open(request_file) as f:
+        batch_ids = [
+            int(json.loads(line)["custom_id"][len(CUSTOM_ID_PREFIX):])
+            for line in f if line.strip()
+        ]
+
+    # Locally triaged rows were graded during export, outside the window
+    window = _seconds(state["exported_at"], state["ingested_at"])
+    graded = state.get("ingested_ok", 0)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT count(*)
+                FROM answers
+                WHERE evaluated_at BETWEEN %s AND %s
+                  AND NOT (id = ANY(%s));
+                """,
+                (state["exported_at"], state["ingested_at"], batch_ids)
+            )
+            interactive = cur.fetchone()[0]
+
+    report = {
+        "window_seconds": round(window, 1),
+        "batch_rows": graded,
+        "batch_failed": state.get("ingested_failed", 0),
+        "batch_released": state.get("ingested_released", 0) + state.get("released", 0),
+        "triaged_locally": state.get("triaged_locally", 0),
+        "batch_rows_per_hour": round(graded * 3600 / window, 1) if window else None,
+        "interactive_rows": interactive,
+        "interactive_rows_per_hour": round(interactive * 3600 / window, 1) if window else None,
+        "ingest_seconds": round(_seconds(state["ingest_started_at"], state["ingested_at"]), 1),
+    }
+
+    print(json.dumps(report, indent=2))
+    return report
+
+# =========================================================
+# ENTRY POINT
+# =========================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deferred bulk grading")
+    parser.add_argument("command", nargs="?",
+                        choices=["export", "submit", "poll", "ingest", "report", "release", "run"])
+    parser.add_argument("request_file", nargs="?")
+    parser.add_argument("--init", action="store_true", help="add the bulk_job column")
+    parser.add_argument("--regrade", action="store_true", help="include already evaluated rows")
+    parser.add_argument("--stale", action="store_true", help="include evaluated rows the re-grade planner counts as stale")
+    parser.add_argument("--limit", type=int, help="export at most N rows")
+    parser.add_argument("--local", action="store_true", help="use the local stand-in instead of a batch endpoint")
+    args = parser.parse_args()
+
+    if args.init:
+        init_schema()
+    if not args.command:
+        if not args.init:
+            parser.print_help()
+        raise SystemExit(0)
+    if not args.request_file:
+        parser.error("request_file is required")
+
+    # Validate the provider before any row is claimed
+    if args.command == "run" and not args.local:
+        check_batch_config()
+
+    if args.command in ("export", "run"):
+        export_requests(args.request_file, regrade=args.regrade or args.stale,
+                        limit=args.limit, stale_only=args.stale)
+
+    if args.command in ("submit", "run"):
+        if args.local:
+            run_local(args.request_file)
+        else:
+            submit_batch(args.request_file)
+
+    if args.command == "poll" or (args.command == "run" and not args.local):
+        poll_batch(args.request_file, wait=args.command == "run")
+
+    if args.command in ("ingest", "run"):
+        ingest_results(args.request_file)
+
+    if args.command == "release":
+        release_rows(args.request_file)
+
+    if args.command in ("report", "run"):
+        throughput_report(args.request_file)
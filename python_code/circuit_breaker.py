@@ -0,0 +1,361 @@
+"""
+===========================================================
+PROVIDER CIRCUIT BREAKER
+-----------------------------------------------------------
+• closed    → calls flow; provider errors are counted over a
+              rolling window
+• open      → error rate crossed the threshold; nobody claims
+              rows or calls the provider until the cooldown ends
+• half_open → one worker at a time makes a probe call;
+              success closes the circuit, failure re-opens it
+              with a longer cooldown
+• State lives in Postgres (provider_circuit) when
+  DATABASE_URL is set, so every worker process shares it;
+  otherwise in memory for this process
+• Only outage-type errors (connection, timeout, 429, 5xx,
+  auth, error events mid-stream) count; a rejected request
+  (400/422) or a bad JSON reply means the provider is up
+• Fails open: if the shared state can't be read or written
+  (missing table, DB down) the breaker falls back to memory
+  for a while and logs a warning, never failing the caller
+===========================================================
+
+Usage:
+    python circuit_breaker.py --init
+    python circuit_breaker.py            # print current state
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+import httpx
+import openai
+from dotenv import load_dotenv
+
+# =========================================================
+# CONFIG
+# =========================================================
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+ERROR_RATE_THRESHOLD = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))
+BASE_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30"))
+MAX_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_MAX_COOLDOWN_SECONDS", "600"))
+PROBE_LEASE_SECONDS = 60
+STORE_RETRY_SECONDS = 60
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+PROVIDER_ERRORS = (
+    openai.APIError,                # includes error events sent mid-stream
+    httpx.TransportError,           # dropped mid-stream
+)
+
+# The provider answered; the request or the reply was at fault
+REQUEST_ERRORS = (
+    openai.BadRequestError,
+    openai.UnprocessableEntityError,
+    openai.APIResponseValidationError,
+)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS provider_circuit (
+    name               TEXT PRIMARY KEY,
+    state              TEXT NOT NULL DEFAULT 'closed',
+    window_started_at  DOUBLE PRECISION NOT NULL DEFAULT 0,
+    calls              INTEGER NOT NULL DEFAULT 0,
+    failures           INTEGER NOT NULL DEFAULT 0,
+    opened_at          DOUBLE PRECISION,
+    cooldown_seconds   DOUBLE PRECISION NOT NULL DEFAULT 30,
+    probe_until        DOUBLE PRECISION,
+    trips              INTEGER NOT NULL DEFAULT 0,
+    probes             INTEGER NOT NULL DEFAULT 0,
+    last_error         TEXT
+);
+"""
+
+FIELDS = [
+    "state", "window_started_at", "calls", "failures", "opened_at",
+    "cooldown_seconds", "probe_until", "trips", "probes", "last_error",
+]
+
+
+class ProviderUnavailable(Exception):
+    """
+    The provider failed with an outage-type error, or the
+    circuit is open. Rows should be left for later, not
+    failed or given a score.
+    """
+
+
+def is_provider_error(error):
+    return isinstance(error, PROVIDER_ERRORS) and not isinstance(error, REQUEST_ERRORS)
+
+
+def _initial_state():
+    return {
+        "state": CLOSED,
+        "window_started_at": time.time(),
+        "calls": 0,
+        "failures": 0,
+        "opened_at": None,
+        "cooldown_seconds": BASE_COOLDOWN_SECONDS,
+        "probe_until": None,
+        "trips": 0,
+        "probes": 0,
+        "last_error": None,
+    }
+
+# =========================================================
+# STATE STORES
+# =========================================================
+class MemoryStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = _initial_state()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self._state
+
+
+class PostgresStore:
+    """
+    One row per breaker; each transition runs under
+    SELECT ... FOR UPDATE so concurrent workers serialize.
+    """
+
+    def __init__(self, name, database_url=DATABASE_URL):
+        self.name = name
+        self.database_url = database_url
+
+    @contextmanager
+    def transaction(self):
+        import psycopg2
+
+        with psycopg2.connect(self.database_url) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO provider_circuit (name, window_started_at) VALUES (%s, %s) "
+                    "ON CONFLICT DO NOTHING;",
+                    (self.name, time.time())
+                )
+                cur.execute(
+                    f"SELECT {', '.join(FIELDS)} FROM provider_circuit WHERE name = %s FOR UPDATE;",
+                    (self.name,)
+                )
+                state = dict(zip(FIELDS, cur.fetchone()))
+
+                yield state
+
+                cur.execute(
+                    f"UPDATE provider_circuit SET {', '.join(f + ' = %s' for f in FIELDS)} "
+                    "WHERE name = %s;",
+                    [state[f] for f in FIELDS] + [self.name]
+                )
+
+# =========================================================
+# BREAKER
+# =========================================================
+class CircuitBreaker:
+    def __init__(self, name, store):
+        self.name = name
+        self.store = store
+        self.fallback = MemoryStore()
+        self.store_down_until = 0.0
+
+    def _run(self, step):
+        """
+        Apply step(state) in one store transaction. Store errors
+        switch this breaker to its in-memory state for
+        STORE_RETRY_SECONDS instead of reaching the caller.
+        """
+        if time.time() >= self.store_down_until:
+            try:
+                with self.store.transaction() as s:
+                    return step(s)
+            except Exception as e:
+                self.store_down_until = time.time() + STORE_RETRY_SECONDS
+                print(f"⚠️ Circuit {self.name} store unavailable, using memory for {STORE_RETRY_SECONDS}s → {e}")
+
+        with self.fallback.transaction() as s:
+            return step(s)
+
+    def acquire(self):
+        """
+        Gate before claiming work or calling the provider.
+        Returns 'closed' (full throughput), 'probe' (this caller
+        holds the single half-open test call) or None (wait).
+        """
+        return self._run(self._acquire)
+
+    def _acquire(self, s):
+        now = time.time()
+        if s["state"] == CLOSED:
+            return CLOSED
+
+        if s["state"] == OPEN:
+            if now < s["opened_at"] + s["cooldown_seconds"]:
+                return None
+            s["state"] = HALF_OPEN
+            print(f"🟡 Circuit {self.name} half-open, probing")
+
+        if s["probe_until"] and now < s["probe_until"]:
+            return None
+        s["probe_until"] = now + PROBE_LEASE_SECONDS
+        s["probes"] += 1
+        return "probe"
+
+    def release_probe(self):
+        """
+        Give back a probe lease that made no provider call
+        (nothing claimed, triaged locally, lost a claim race),
+        so the next caller can probe now instead of after
+        PROBE_LEASE_SECONDS. No-op once the probe has closed
+        or re-opened the circuit.
+        """
+        self._run(self._release_probe)
+
+    def _release_probe(self, s):
+        if s["state"] == HALF_OPEN:
+            s["probe_until"] = None
+
+    def is_closed(self):
+        return self._run(lambda s: s["state"] == CLOSED)
+
+    def record_success(self):
+        self._run(self._record_success)
+
+    def _record_success(self, s):
+        now = time.time()
+        if s["state"] == HALF_OPEN:
+            s.update({
+                "state": CLOSED,
+                "window_started_at": now,
+                "calls": 0,
+                "failures": 0,
+                "opened_at": None,
+                "cooldown_seconds": BASE_COOLDOWN_SECONDS,
+                "probe_until": None,
+            })
+            print(f"🟢 Circuit {self.name} closed, provider recovered")
+        elif s["state"] == CLOSED:
+            self._roll(s, now)
+            s["calls"] += 1
+        # OPEN: a straggler from before the trip, ignore
+
+    def record_failure(self, error):
+        self._run(lambda s: self._record_failure(s, error))
+
+    def _record_failure(self, s, error):
+        now = time.time()
+        s["last_error"] = str(error)[:200]
+
+        if s["state"] == HALF_OPEN:
+            cooldown = min(s["cooldown_seconds"] * 2, MAX_COOLDOWN_SECONDS)
+            self._trip(s, now, cooldown)
+            return
+        if s["state"] == OPEN:
+            return
+
+        self._roll(s, now)
+        s["calls"] += 1
+        s["failures"] += 1
+        if s["calls"] >= MIN_CALLS and s["failures"] / s["calls"] >= ERROR_RATE_THRESHOLD:
+            self._trip(s, now, BASE_COOLDOWN_SECONDS)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run one provider call and record its outcome.
+        Outage errors are re-raised as ProviderUnavailable;
+        any other error still proves the provider answered.
+        Bookkeeping never raises, so a successful call always
+        returns its result.
+        """
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_provider_error(e):
+                self.record_failure(e)
+                raise ProviderUnavailable(str(e)) from e
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        state = self._run(dict)
+
+        now = time.time()
+        reopen_in = None
+        if state["state"] == OPEN:
+            reopen_in = max(0.0, state["opened_at"] + state["cooldown_seconds"] - now)
+
+        return {
+            "name": self.name,
+            "state": state["state"],
+            "window_calls": state["calls"],
+            "window_failures": state["failures"],
+            "error_rate": round(state["failures"] / state["calls"], 3) if state["calls"] else 0.0,
+            "threshold": ERROR_RATE_THRESHOLD,
+            "trips": state["trips"],
+            "probes": state["probes"],
+            "cooldown_seconds": state["cooldown_seconds"],
+            "half_open_in_seconds": round(reopen_in, 1) if reopen_in is not None else None,
+            "last_error": state["last_error"],
+            "store_fallback": time.time() < self.store_down_until,
+        }
+
+    def _roll(self, s, now):
+        if now - s["window_started_at"] >= WINDOW_SECONDS:
+            s["window_started_at"] = now
+            s["calls"] = 0
+            s["failures"] = 0
+
+    def _trip(self, s, now, cooldown):
+        s.update({
+            "state": OPEN,
+            "opened_at": now,
+            "cooldown_seconds": cooldown,
+            "probe_until": None,
+        })
+        s["trips"] += 1
+        print(f"🔴 Circuit {self.name} open for {cooldown:.0f}s → {s['last_error']}")
+
+
+def make_breaker(name="perplexity"):
+    """
+    Shared Postgres-backed breaker when DATABASE_URL is set,
+    otherwise a per-process one.
+    """
+    store = PostgresStore(name) if DATABASE_URL else MemoryStore()
+    return CircuitBreaker(name, store)
+
+# =========================================================
+# ENTRY POINT
+# =========================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Provider circuit breaker")
+    parser.add_argument("--init", action="store_true", help="create provider_circuit table")
+    parser.add_argument("--name", default="perplexity")
+    args = parser.parse_args()
+
+    if args.init:
+        import psycopg2
+
+        with psycopg2.connect(DATABASE_URL) as conn:
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA_SQL)
+        print("✅ provider_circuit table ready")
+    else:
+        print(json.dumps(make_breaker(args.name).snapshot(), indent=2))
@@ -6,6 +6,7 @@ PARALLEL SAFE AI ANSWER EVALUATION AGENT
 • Uses DB row locking via status='processing'
 • Retries failed answers
 • Skips already evaluated answers
+• Stops claiming while the provider circuit is open
 ===========================================================
 """
 
@@ -18,6 +19,12 @@ from dotenv import load_dotenv
 from openai import OpenAI
 import psycopg2
 
+from score_aggregates import record_score, student_column
+from lexical_scorer import triage, breakdown_result, lexical_fingerprint
+from grading_fingerprint import request_fingerprint
+from stream_grading import stream_json
+from circuit_breaker import make_breaker, ProviderUnavailable
+
 # =========================================================
 # CONFIG
 # =========================================================
@@ -36,6 +43,12 @@ client = OpenAI(
     base_url="https://api.perplexity.ai"
 )
 
+# Shared by every worker process through the provider_circuit table
+breaker = make_breaker()
+
+# Student key for the summaries (ANSWERS_STUDENT_COLUMN)
+STUDENT_SQL = student_column("answers", "a")
+
 # =========================================================
 # STRICT RUBRIC
 # =========================================================
@@ -55,32 +68,40 @@ def get_conn():
 # =========================================================
 # ATOMIC FETCH + LOCK (CRITICAL)
 # =========================================================
-def fetch_and_lock_answers():
+def fetch_and_lock_answers(limit=BATCH_SIZE):
     """
     Atomically:
-    1. Select pending/failed answers
+    1. Select pending/failed answers, then queued re-grades
     2. Mark them as 'processing'
     3. Return them to THIS worker only
+
+    total_score/evaluated_at are returned untouched, so a
+    re-grade can take its old score out of the summaries.
+    The original status is returned so unprocessed rows can
+    be handed back as they were.
     """
 
-    query = """
-        UPDATE answers
-        SET status = 'processing'
-        WHERE id IN (
-            SELECT id
+    query = f"""
+        WITH picked AS (
+            SELECT id, status
             FROM answers
-            WHERE status IN ('pending', 'failed')
+            WHERE status IN ('pending', 'failed', 'regrade')
               AND retry_count < %s
-            ORDER BY id
+            ORDER BY (status = 'regrade'), id
             LIMIT %s
             FOR UPDATE SKIP LOCKED
         )
-        RETURNING id, question, answer, retry_count;
+        UPDATE answers AS a
+        SET status = 'processing'
+        FROM picked
+        WHERE a.id = picked.id
+        RETURNING a.id, a.question, a.answer, a.retry_count, {STUDENT_SQL},
+                  a.total_score, a.evaluated_at, picked.status;
     """
 
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(query, (MAX_RETRIES, BATCH_SIZE))
+            cur.execute(query, (MAX_RETRIES, limit))
             rows = cur.fetchall()
 
     return [
@@ -88,7 +109,11 @@ def fetch_and_lock_answers():
             "id": r[0],
             "question": r[1],
             "answer": r[2],
-            "retry_count": r[3]
+            "retry_count": r[3],
+            "student": r[4],
+            # Only rows that were graded before count in the summaries
+            "previous_score": r[5] if r[6] is not None else None,
+            "claimed_status": r[7]
         }
         for r in rows
     ]
@@ -96,7 +121,8 @@ def fetch_and_lock_answers():
 # =========================================================
 # DB UPDATE HELPERS
 # =========================================================
-def mark_success(answer_id, result):
+def mark_success(answer_id, result, question=None, student=None,
+                 previous_score=None, fingerprint=None):
     query = """
         UPDATE answers
         SET status = 'evaluated',
@@ -106,7 +132,8 @@ def mark_success(answer_id, result):
             language_score = %s,
             grade = %s,
             feedback = %s,
-            evaluated_at = %s
+            evaluated_at = %s,
+            grading_fingerprint = %s
         WHERE id = %s;
     """
     with get_conn() as conn:
@@ -119,8 +146,13 @@ def mark_success(answer_id, result):
                 result["grade"],
                 result["feedback"],
                 datetime.utcnow(),
+                fingerprint or FINGERPRINT,
                 answer_id
             ))
+            # Same transaction: summaries never drift from the rows
+            if previous_score is not None:
+                record_score(cur, "answers", question, student, previous_score, -1)
+            record_score(cur, "answers", question, student, result["total_score"])
 
 def mark_failure(answer_id, retry_count):
     status = 'failed' if retry_count < MAX_RETRIES else 'failed'
@@ -134,10 +166,29 @@ def mark_failure(answer_id, retry_count):
         with conn.cursor() as cur:
             cur.execute(query, (status, retry_count, answer_id))
 
+def release_answer(ans):
+    """
+    Hand a claimed row back untouched (no retry_count bump),
+    e.g. when the provider is down.
+    """
+    query = """
+        UPDATE answers
+        SET status = %s
+        WHERE id = %s
+          AND status = 'processing';
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (ans["claimed_status"], ans["id"]))
+
 # =========================================================
 # AI EVALUATION
 # =========================================================
-def evaluate_answer(question, answer):
+def build_request(question, answer, model="sonar-pro"):
+    """
+    Chat completion arguments for one answer. Shared with the
+    bulk path, which writes them into a batch request file.
+    """
     prompt = f"""
 {RUBRIC}
 
@@ -148,17 +199,17 @@ ANSWER:
 {answer[:1500]}
 """
 
-    response = client.chat.completions.create(
-        model="sonar-pro",
-        temperature=0.1,
-        max_tokens=300,
-        messages=[
+    return {
+        "model": model,
+        "temperature": 0.1,
+        "max_tokens": 300,
+        "messages": [
             {"role": "system", "content": "Return JSON only."},
             {"role": "user", "content": prompt}
         ]
-    )
+    }
 
-    raw = response.choices[0].message.content
+def parse_output(raw):
     match = re.search(r"\{.*\}", raw, re.DOTALL)
 
     if not match:
@@ -166,6 +217,19 @@ ANSWER:
 
     return json.loads(match.group(0))
 
+# Stamped on every LLM result; changes whenever RUBRIC, the
+# model or the request parameters change.
+FINGERPRINT = request_fingerprint(build_request("", ""))
+
+def evaluate_answer(question, answer):
+    # Streamed: generation stops once an object with a total_score arrives
+    result, _ = breaker.call(
+        stream_json,
+        client, build_request(question, answer),
+        validate=lambda d: isinstance(d, dict) and "total_score" in d
+    )
+    return result
+
 # =========================================================
 # PARALLEL AGENT LOOP
 # =========================================================
@@ -173,25 +237,61 @@ def run_worker():
     print("🧠 Parallel Evaluation Worker started")
 
     while True:
-        batch = fetch_and_lock_answers()
+        mode = breaker.acquire()
+        if mode is None:
+            print("⏸ Provider circuit open. Not claiming rows...")
+            time.sleep(SLEEP_BETWEEN_CYCLES)
+            continue
+
+        # Half-open: claim a single row as the test call
+        batch = fetch_and_lock_answers(1 if mode == "probe" else BATCH_SIZE)
 
         if not batch:
+            if mode == "probe":
+                breaker.release_probe()
             print("No work found. Sleeping...")
             time.sleep(SLEEP_BETWEEN_CYCLES)
             continue
 
-        for ans in batch:
+        # Confident local scores skip the LLM call entirely.
+        # No reference answer in answers: only blanks qualify.
+        provisional = triage(batch)
+
+        for ans, local in zip(batch, provisional):
+            # Circuit tripped mid-batch (possibly by another worker)
+            if local is None and mode == "closed" and not breaker.is_closed():
+                release_answer(ans)
+                continue
+
             try:
-                print(f"Evaluating ID {ans['id']}")
-                result = evaluate_answer(ans["question"], ans["answer"])
-                mark_success(ans["id"], result)
+                if local is not None:
+                    print(f"⚡ Triaged ID {ans['id']} locally ({local['reason']}, confidence={local['confidence']})")
+                    result = breakdown_result(local)
+                    fingerprint = lexical_fingerprint(FINGERPRINT)
+                else:
+                    print(f"Evaluating ID {ans['id']}")
+                    result = evaluate_answer(ans["question"], ans["answer"])
+                    fingerprint = FINGERPRINT
+                mark_success(
+                    ans["id"], result, ans["question"], ans["student"],
+                    ans["previous_score"], fingerprint
+                )
                 print(f"✔ Completed ID {ans['id']}")
 
+            except ProviderUnavailable as e:
+                print(f"⏸ Provider unavailable, released ID {ans['id']} → {e}")
+                release_answer(ans)
+
             except Exception as e:
                 print(f"✖ Failed ID {ans['id']} → {e}")
                 mark_failure(ans["id"], ans["retry_count"] + 1)
 
-            time.sleep(SLEEP_BETWEEN_EVALS)
+            if local is None:
+                time.sleep(SLEEP_BETWEEN_EVALS)
+
+        # Probe row was triaged locally: no provider call was made
+        if mode == "probe":
+            breaker.release_probe()
 
 # =========================================================
 # ENTRY POINT
@@ -0,0 +1,24 @@
+"""
+===========================================================
+GRADING FINGERPRINTS
+-----------------------------------------------------------
+• Short hash of everything that decides a grade except the
+  answer itself: rubric text, model, system prompt and
+  sampling parameters
+• Stored with each result so stale rows can be found after
+  a rubric or model change
+===========================================================
+"""
+
+import json
+import hashlib
+
+
+def request_fingerprint(template):
+    """
+    Fingerprint of a chat completion request built with empty
+    question/answer, e.g. request_fingerprint(build_request("", "")).
+    Any dict of JSON-serialisable settings works.
+    """
+    canonical = json.dumps(template, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,336 @@
+"""
+===========================================================
+LOCAL LEXICAL SCORER (LLM TRIAGE)
+-----------------------------------------------------------
+• Runs offline on CPU, no API calls
+• BM25-weighted TF-IDF vectors per question (scipy sparse)
+• Compares each answer with the question text and an
+  optional reference (model) answer
+• Returns a provisional 0–10 score and a confidence;
+  only low-confidence rows need the LLM
+• Off by default: set TRIAGE_CONFIDENCE once the agreement
+  report has validated a threshold
+• Verbatim and off-topic calls need a reference answer. The
+  database tables have none, so the worker, main2 and bulk
+  export only triage blank answers; the Excel endpoint
+  (reference_answer / model_answer column) gets all three
+• Agreement report against LLM scores on a held-out set
+===========================================================
+
+Usage:
+    python lexical_scorer.py held_out.xlsx
+    (columns: question, answer, llm_score, optional reference_answer)
+"""
+
+import os
+import re
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from score_aggregates import question_key
+from grading_fingerprint import request_fingerprint
+
+# =========================================================
+# CONFIG
+# =========================================================
+# Unset → triage disabled, every row goes to the LLM
+CONFIDENCE_THRESHOLD = (
+    float(os.getenv("TRIAGE_CONFIDENCE")) if os.getenv("TRIAGE_CONFIDENCE") else None
+)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Cosine similarity to the reference answer: confidence ramps
+# from 0 at VERBATIM_LOW to 1 at VERBATIM_HIGH.
+VERBATIM_LOW = 0.60
+VERBATIM_HIGH = 0.95
+
+# Off-topic needs a reference answer: a correct answer often
+# shares no words with the question, so question similarity
+# alone never justifies a zero. Full confidence only when the
+# answer is non-trivial and has near-zero similarity to both;
+# otherwise it stays capped well below any sensible threshold.
+OFF_TOPIC_MAX = 0.15
+OFF_TOPIC_REFERENCE_MAX = 0.02
+OFF_TOPIC_MIN_TOKENS = 8
+OFF_TOPIC_CAPPED_CONFIDENCE = 0.3
+
+STOPWORDS = frozenset("""
+a an the and or but if then else of to in on at by for with from as is are was were be
+been being it its this that these those there their they them he she we you i my our your
+his her not no do does did so such can could will would shall should may might must also
+than very into about over under which who whom what when where why how all any each more
+most other some only own same too just
+""".split())
+
+# Settings of the local scorer itself
+LEXICAL_FINGERPRINT = "lexical-" + request_fingerprint({
+    "k1": BM25_K1,
+    "b": BM25_B,
+    "verbatim": [VERBATIM_LOW, VERBATIM_HIGH],
+    "off_topic": [OFF_TOPIC_MAX, OFF_TOPIC_REFERENCE_MAX, OFF_TOPIC_MIN_TOKENS],
+    "stopwords": sorted(STOPWORDS),
+})
+
+def lexical_fingerprint(grader_fingerprint):
+    """
+    Stamp for a locally triaged row. Carries the LLM grader's
+    fingerprint too, so the row goes stale on a rubric change
+    just like an LLM-graded one.
+    """
+    return f"{LEXICAL_FINGERPRINT}+{grader_fingerprint}"
+
+# =========================================================
+# VECTORIZATION
+# =========================================================
+def tokenize(text):
+    if not isinstance(text, str):
+        text = "" if text is None or pd.isna(text) else str(text)
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    out = []
+    for t in tokens:
+        if t in STOPWORDS or len(t) < 2:
+            continue
+        # Cheap plural folding: "forces" / "force" share a term
+        if len(t) > 3 and t.endswith("s") and not t.endswith("ss"):
+            t = t[:-1]
+        out.append(t)
+    return out
+
+
+def bm25_matrix(token_lists):
+    """
+    L2-normalised BM25 document vectors (CSR, one row per
+    token list) over a vocabulary built from the same lists.
+    """
+    vocab = {}
+    rows, cols, vals = [], [], []
+    for i, tokens in enumerate(token_lists):
+        for term, count in Counter(tokens).items():
+            rows.append(i)
+            cols.append(vocab.setdefault(term, len(vocab)))
+            vals.append(count)
+
+    n_docs = len(token_lists)
+    tf = sparse.csr_matrix(
+        (np.asarray(vals, dtype=float), (rows, cols)),
+        shape=(n_docs, max(len(vocab), 1))
+    )
+
+    doc_len = np.asarray(tf.sum(axis=1)).ravel()
+    avg_len = doc_len.mean() if doc_len.any() else 1.0
+    row_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)
+    tf.data = tf.data * (BM25_K1 + 1) / (tf.data + np.repeat(row_norm, np.diff(tf.indptr)))
+
+    # Smoothed IDF: shared terms are discounted but never zeroed,
+    # which matters for tiny groups (one answer + the question).
+    df = np.bincount(tf.indices, minlength=tf.shape[1])
+    idf = np.log((1 + n_docs) / (1 + df)) + 1
+    weighted = tf @ sparse.diags(idf)
+
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    inv = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.diags(inv) @ weighted
+
+# =========================================================
+# SCORING
+# =========================================================
+def score_group(question, answers, reference=None):
+    """
+    Provisional scores for answers to one question.
+
+    Returns one dict per answer:
+        score       — provisional integer score 0–10
+        confidence  — 0..1, how safe it is to skip the LLM
+        reason      — 'blank' | 'verbatim' | 'off_topic' | 'uncertain'
+    """
+    has_reference = bool(reference and str(reference).strip())
+
+    docs = [tokenize(a) for a in answers]
+    docs.append(tokenize(question))
+    if has_reference:
+        docs.append(tokenize(reference))
+
+    X = bm25_matrix(docs)
+    n = len(answers)
+    answer_vecs = X[:n]
+
+    sim_question = np.asarray((answer_vecs @ X[n].T).todense()).ravel()
+    if has_reference:
+        sim_reference = np.asarray((answer_vecs @ X[n + 1].T).todense()).ravel()
+    else:
+        sim_reference = np.zeros(n)
+
+    if has_reference:
+        relevance = np.maximum(sim_question, sim_reference)
+        off_topic_conf = np.clip(1 - relevance / OFF_TOPIC_MAX, 0, 1)
+        long_enough = np.array([len(t) >= OFF_TOPIC_MIN_TOKENS for t in docs[:n]])
+        clearly_off = long_enough & (sim_reference <= OFF_TOPIC_REFERENCE_MAX)
+        off_topic_conf = np.where(
+            clearly_off, off_topic_conf,
+            np.minimum(off_topic_conf, OFF_TOPIC_CAPPED_CONFIDENCE)
+        )
+        verbatim_conf = np.clip(
+            (sim_reference - VERBATIM_LOW) / (VERBATIM_HIGH - VERBATIM_LOW), 0, 1
+        )
+    else:
+        off_topic_conf = np.zeros(n)
+        verbatim_conf = np.zeros(n)
+
+    results = []
+    for i, tokens in enumerate(docs[:n]):
+        if not tokens:
+            results.append({"score": 0, "confidence": 1.0, "reason": "blank"})
+            continue
+
+        if verbatim_conf[i] > off_topic_conf[i]:
+            score = int(round(10 * sim_reference[i]))
+            confidence, reason = verbatim_conf[i], "verbatim"
+        else:
+            score = 0
+            confidence, reason = off_topic_conf[i], "off_topic"
+
+        if confidence == 0:
+            reason = "uncertain"
+
+        results.append({
+            "score": max(0, min(score, 10)),
+            "confidence": round(float(confidence), 3),
+            "reason": reason,
+        })
+
+    return results
+
+
+def score_rows(rows):
+    """
+    Score a list of dicts with question, answer and optional
+    reference_answer, grouping by question so each group
+    shares one vocabulary. Output is aligned with the input.
+    """
+    groups = {}
+    for idx, row in enumerate(rows):
+        groups.setdefault(question_key(row["question"]), []).append(idx)
+
+    results = [None] * len(rows)
+    for idxs in groups.values():
+        first = rows[idxs[0]]
+        reference = next(
+            (
+                rows[i]["reference_answer"] for i in idxs
+                if isinstance(rows[i].get("reference_answer"), str)
+                and rows[i]["reference_answer"].strip()
+            ),
+            None
+        )
+        scored = score_group(
+            first["question"], [rows[i]["answer"] for i in idxs], reference
+        )
+        for i, res in zip(idxs, scored):
+            results[i] = res
+
+    return results
+
+
+def triage(rows, threshold=None):
+    """
+    Provisional result for every row that can skip the LLM,
+    None for rows that still need it. Aligned with the input.
+    All None while triage is disabled (no threshold).
+    """
+    threshold = CONFIDENCE_THRESHOLD if threshold is None else threshold
+    if threshold is None:
+        return [None] * len(rows)
+    return [
+        res if res["confidence"] >= threshold else None
+        for res in score_rows(rows)
+    ]
+
+
+def triage_feedback(result):
+    if result["reason"] == "blank":
+        return "No answer submitted."
+    if result["reason"] == "verbatim":
+        return "Answer closely matches the expected answer and covers the key points."
+    return "Answer does not address the question asked."
+
+
+def breakdown_result(result):
+    """
+    Provisional result in the format returned by
+    main.grade_answer and stored by the parallel worker. The
+    scorer only produces a total, so the sub-scores are left
+    empty rather than invented.
+    """
+    score = result["score"]
+    if score >= 8:
+        grade = "A"
+    elif score >= 6:
+        grade = "B"
+    elif score >= 4:
+        grade = "C"
+    else:
+        grade = "F"
+
+    return {
+        "total_score": score,
+        "content_score": None,
+        "organization_score": None,
+        "language_score": None,
+        "grade": grade,
+        "feedback": triage_feedback(result),
+    }
+
+# =========================================================
+# AGREEMENT REPORT
+# =========================================================
+def agreement_report(df, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95)):
+    """
+    Compare provisional scores with LLM scores on a held-out
+    DataFrame (question, answer, llm_score, optional
+    reference_answer). One row per threshold: share of API
+    calls saved and agreement on the rows that would skip.
+    """
+    df = df.dropna(subset=["llm_score"]).reset_index(drop=True)
+    rows = df.to_dict("records")
+    scored = pd.DataFrame(score_rows(rows))
+
+    llm = df["llm_score"].astype(float).to_numpy()
+    local = scored["score"].to_numpy(dtype=float)
+    conf = scored["confidence"].to_numpy()
+
+    report = []
+    for t in thresholds:
+        mask = conf >= t
+        k = int(mask.sum())
+        err = np.abs(local[mask] - llm[mask])
+        report.append({
+            "threshold": t,
+            "rows": len(df),
+            "skipped": k,
+            "calls_saved_pct": round(100 * k / len(df), 1) if len(df) else 0.0,
+            "exact_pct": round(100 * float((err == 0).mean()), 1) if k else None,
+            "within_1_pct": round(100 * float((err <= 1).mean()), 1) if k else None,
+            "mae": round(float(err.mean()), 2) if k else None,
+        })
+
+    return pd.DataFrame(report)
+
+# =========================================================
+# ENTRY POINT
+# =========================================================
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python lexical_scorer.py held_out.xlsx")
+        sys.exit(1)
+
+    path = sys.argv[1]
+    held_out = pd.read_csv(path) if path.endswith(".csv") else pd.read_excel(path)
+    held_out.columns = [c.lower().strip() for c in held_out.columns]
+
+    print(agreement_report(held_out).to_string(index=False))
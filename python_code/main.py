@@ -10,8 +10,6 @@ AI ANSWER EVALUATOR API
 """
 
 import os
-import json
-import re
 import pandas as pd
 from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import JSONResponse
@@ -19,6 +17,11 @@ from dotenv import load_dotenv
 from openai import OpenAI
 from fastapi.middleware.cors import CORSMiddleware
 
+from lexical_scorer import triage, breakdown_result, lexical_fingerprint
+from grading_fingerprint import request_fingerprint
+from stream_grading import stream_json, stream_stats
+from circuit_breaker import make_breaker, ProviderUnavailable
+
 
 # =========================================================
 # ENV SETUP
@@ -49,6 +52,9 @@ client = OpenAI(
     base_url="https://api.perplexity.ai"
 )
 
+# Shared with the workers when DATABASE_URL is set
+breaker = make_breaker()
+
 # =========================================================
 # FASTAPI APP
 # =========================================================
@@ -201,17 +207,7 @@ ABSOLUTE CONSTRAINTS:
 # =========================================================
 # CORE GRADING FUNCTION
 # =========================================================
-def grade_answer(question: str, answer: str) -> dict:
-    if pd.isna(answer) or str(answer).strip() == "":
-        return {
-            "total_score": 0,
-            "content_score": 0,
-            "organization_score": 0,
-            "language_score": 0,
-            "grade": "F",
-            "feedback": "No answer submitted"
-        }
-
+def build_request(question: str, answer: str) -> dict:
     prompt = f"""
 {GRADING_RUBRIC}
 
@@ -222,24 +218,50 @@ STUDENT ANSWER:
 {answer[:1500]}
 """
 
-    try:
-        response = client.chat.completions.create(
-            model="sonar-pro",
-            temperature=0.1,
-            max_tokens=300,
-            messages=[
-                {"role": "system", "content": "Return JSON only."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+    return {
+        "model": "sonar-pro",
+        "temperature": 0.1,
+        "max_tokens": 300,
+        "messages": [
+            {"role": "system", "content": "Return JSON only."},
+            {"role": "user", "content": prompt}
+        ]
+    }
 
-        raw = response.choices[0].message.content
+# Returned with every result so re-grades can tell which rubric,
+# model and parameters produced a score
+GRADING_FINGERPRINT = request_fingerprint(build_request("", ""))
 
-        # Extract JSON safely
-        match = re.search(r"\{.*\}", raw, re.DOTALL)
-        json_str = match.group(0) if match else raw
+SCORE_KEYS = ["total_score", "content_score", "organization_score", "language_score"]
 
-        result = json.loads(json_str) ## Convert JSON to Python dictionary.
+def has_scores(data) -> bool:
+    # The stream stops at the first object that passes, so an
+    # empty or example object in preamble text must not
+    if not isinstance(data, dict):
+        return False
+    return all(
+        isinstance(data.get(k), (int, float)) and not isinstance(data.get(k), bool)
+        for k in SCORE_KEYS
+    )
+
+def grade_answer(question: str, answer: str) -> dict:
+    if pd.isna(answer) or str(answer).strip() == "":
+        return {
+            "total_score": 0,
+            "content_score": 0,
+            "organization_score": 0,
+            "language_score": 0,
+            "grade": "F",
+            "feedback": "No answer submitted"
+        }
+
+    try:
+        # Streamed: the call ends at the first complete JSON object
+        result, _ = breaker.call(
+            stream_json,
+            client, build_request(question, answer),
+            validate=has_scores
+        )
 
         # Safety validation
         for k in [
@@ -256,6 +278,10 @@ STUDENT ANSWER:
 
         return result
 
+    except ProviderUnavailable:
+        # An outage is not a grade; the endpoint reports it instead
+        raise
+
     except Exception as e:
         return {
             "total_score": 0,
@@ -296,21 +322,65 @@ async def evaluate_excel(file: UploadFile = File(...)):
             }
         )
 
+    # Optional model answer column improves local triage
+    if "reference_answer" not in df.columns and "model_answer" in df.columns:
+        df["reference_answer"] = df["model_answer"]
+
+    rows = df.to_dict("records")
+    provisional = triage(rows)
+
+    # 'closed', or 'probe' when this request makes the half-open test call
+    mode = breaker.acquire()
+
     results = []
+    triaged = 0
 
     # Evaluate row by row
-    for _, row in df.iterrows():
-        evaluation = grade_answer(row["question"], row["answer"])
+    for row, local in zip(rows, provisional):
+        if local is not None:
+            evaluation = breakdown_result(local)
+            evaluation["grading_fingerprint"] = lexical_fingerprint(GRADING_FINGERPRINT)
+            triaged += 1
+        else:
+            if mode is None or (mode == "closed" and not breaker.is_closed()):
+                return provider_unavailable(len(results))
+            try:
+                evaluation = grade_answer(row["question"], row["answer"])
+            except ProviderUnavailable:
+                return provider_unavailable(len(results))
+            # A blank answer makes no call, so the probe stays pending
+            if mode == "probe" and breaker.is_closed():
+                mode = "closed"
+            evaluation["grading_fingerprint"] = GRADING_FINGERPRINT
         evaluation["roll_number"] = row["roll_number"]
         results.append(evaluation)
 
+    # Every row was triaged locally or blank: no probe call made
+    if mode == "probe":
+        breaker.release_probe()
+
     # FINAL JSON RESPONSE
     return {
         "status": "success",
         "total_records": len(results),
+        "triaged_locally": triaged,
         "results": results
     }
 
+def provider_unavailable(done: int):
+    """
+    503 instead of score-0 rows; the whole file can be
+    re-submitted once the provider recovers.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={
+            "error": "AI provider unavailable, please retry later",
+            "evaluated_before_outage": done,
+            "circuit": breaker.snapshot()
+        }
+    )
+
 # =========================================================
 # HEALTH CHECK
 # =========================================================
@@ -318,6 +388,13 @@ async def evaluate_excel(file: UploadFile = File(...)):
 def health():
     return {"status": "Excel JSON Evaluator API running"}
 
+@app.get("/api/metrics")
+def metrics():
+    return {
+        "circuit": breaker.snapshot(),
+        "streaming": stream_stats()
+    }
+
 
 #==========================
 # Command to run the app
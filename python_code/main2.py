@@ -1,17 +1,21 @@
 import os
-import json
-import re
 import time
 import traceback
 from datetime import datetime, timezone
 
 
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from supabase import create_client
 from openai import OpenAI
 
+from score_aggregates import record_score_rpc, describe, CLASS_KEY, SOURCES
+from lexical_scorer import triage, triage_feedback, lexical_fingerprint
+from grading_fingerprint import request_fingerprint
+from stream_grading import stream_json, stream_stats
+from circuit_breaker import make_breaker, ProviderUnavailable
+
 # =========================================================
 # ENV
 # =========================================================
@@ -43,6 +47,9 @@ client = OpenAI(
 
 TABLE_NAME = "manual_evaluations"
 
+# Shared with the workers when DATABASE_URL is set
+breaker = make_breaker()
+
 # =========================================================
 # FASTAPI
 # =========================================================
@@ -108,13 +115,7 @@ NO extra text. NO markdown.
 # AI GRADER (FIXED)
 # =========================================================
 
-def grade_answer(question: str, answer: str) -> dict:
-    if not answer or not answer.strip():
-        return {
-            "score": 0,
-            "feedback": "No answer submitted."
-        }
-
+def build_request(question: str, answer: str) -> dict:
     prompt = f"""
 {GRADING_RUBRIC}
 
@@ -125,27 +126,39 @@ STUDENT ANSWER:
 {answer[:20000]}
 """
 
-    response = client.chat.completions.create(
-        model="sonar-pro",
-        temperature=0,
-        max_tokens=700,
-        messages=[
+    return {
+        "model": "sonar-pro",
+        "temperature": 0,
+        "max_tokens": 700,
+        "messages": [
             {"role": "system", "content": "Return valid JSON only"},
             {"role": "user", "content": prompt}
         ]
-    )
-
-    raw = response.choices[0].message.content.strip()
+    }
 
-    # Extract JSON safely
-    match = re.search(r"\{[\s\S]*?\}", raw)
-    if not match:
-        raise ValueError("AI response does not contain JSON")
+# Stamped on every result; changes with the rubric, model or parameters
+GRADING_FINGERPRINT = request_fingerprint(build_request("", ""))
 
+def has_score(data) -> bool:
+    if not isinstance(data, dict) or data.get("score") is None:
+        return False
     try:
-        data = json.loads(match.group(0))
-    except json.JSONDecodeError:
-        raise ValueError("Invalid JSON returned by AI")
+        float(data["score"])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def grade_answer(question: str, answer: str) -> dict:
+    if not answer or not answer.strip():
+        return {
+            "score": 0,
+            "feedback": "No answer submitted."
+        }
+
+    # Stream stops as soon as a usable {"score", "feedback"} object arrives
+    data, _ = breaker.call(
+        stream_json, client, build_request(question, answer), validate=has_score
+    )
 
     # ✅ CORRECT KEY
     score = data.get("score")
@@ -180,31 +193,67 @@ STUDENT ANSWER:
 # =========================================================
 
 def process_pending_evaluations():
+    mode = breaker.acquire()
+    if mode is None:
+        print("⏸ Provider circuit open. Not claiming rows")
+        return
+
     response = (
         supabase
         .table(TABLE_NAME)
-        .select("eval_id, question, answer")
-        .in_("evaluation_status", ["PENDING", "FAILED"])
+        .select("eval_id, question, answer, auth_user_id, score, evaluated_at, evaluation_status")
+        .in_("evaluation_status", ["PENDING", "FAILED", "REGRADE"])
+        .order("evaluation_status")  # REGRADE sorts after FAILED/PENDING
         .order("created_at")
-        .limit(5)
+        .limit(1 if mode == "probe" else 5)
         .execute()
     )
 
     rows = response.data or []
     print(f"📦 Rows fetched: {len(rows)}")
 
-    for row in rows:
+    # No reference answer column here: only blanks are triaged
+    provisional = triage(rows)
+
+    for row, local in zip(rows, provisional):
         eval_id = row["eval_id"]
 
-        # Lock row
-        supabase.table(TABLE_NAME) \
+        # Circuit tripped mid-batch: leave the rest untouched
+        if local is None and mode == "closed" and not breaker.is_closed():
+            print("⏸ Provider circuit open. Leaving remaining rows")
+            break
+
+        # Lock row, only if nobody claimed it since the select;
+        # otherwise two instances would grade it and count it twice
+        claim = supabase.table(TABLE_NAME) \
             .update({"evaluation_status": "PROCESSING"}) \
             .eq("eval_id", eval_id) \
+            .eq("evaluation_status", row["evaluation_status"]) \
             .execute()
 
+        if not claim.data:
+            print(f"⏭ Already claimed | eval_id={eval_id}")
+            continue
+
         try:
-            result = grade_answer(row["question"], row["answer"])
-            print(f"🧠 AI result | eval_id={eval_id} | {result}")
+            if local is not None:
+                result = {"score": local["score"], "feedback": triage_feedback(local)}
+                fingerprint = lexical_fingerprint(GRADING_FINGERPRINT)
+                print(f"⚡ Local result | eval_id={eval_id} | {local}")
+            else:
+                result = grade_answer(row["question"], row["answer"])
+                fingerprint = GRADING_FINGERPRINT
+                print(f"🧠 AI result | eval_id={eval_id} | {result}")
+
+        except ProviderUnavailable as e:
+            print(f"⏸ PROVIDER UNAVAILABLE | eval_id={eval_id} | {e}")
+
+            # Hand the row back as it was; an outage is not a failure
+            supabase.table(TABLE_NAME) \
+                .update({"evaluation_status": row["evaluation_status"]}) \
+                .eq("eval_id", eval_id) \
+                .execute()
+            continue
 
         except Exception as e:
             print(f"❌ AI FAILED | eval_id={eval_id} | {e}")
@@ -222,17 +271,92 @@ def process_pending_evaluations():
                     "score": result["score"],
                     "feedback": result["feedback"],
                     "evaluation_status": "EVALUATED",
-                    "evaluated_at": datetime.now(timezone.utc).isoformat()
+                    "evaluated_at": datetime.now(timezone.utc).isoformat(),
+                    "grading_fingerprint": fingerprint
                 }) \
                 .eq("eval_id", eval_id) \
+                .eq("evaluation_status", "PROCESSING") \
                 .execute()
 
+            if not res.data:
+                print(f"⚠️ Row no longer ours | eval_id={eval_id}")
+                continue
+
             print(f"✅ EVALUATED | eval_id={eval_id} | score={result['score']}")
             print("🧾 DB response:", res)
 
         except Exception as db_error:
             print(f"⚠️ DB UPDATE FAILED | eval_id={eval_id} | {db_error}")
             traceback.print_exc()
+            continue
+
+        try:
+            # Re-graded rows: take the old score out first
+            if row.get("evaluated_at") and row.get("score") is not None:
+                record_score_rpc(
+                    supabase, TABLE_NAME,
+                    row["question"], row.get("auth_user_id"), row["score"], -1
+                )
+            record_score_rpc(
+                supabase, TABLE_NAME,
+                row["question"], row.get("auth_user_id"), result["score"]
+            )
+        except Exception as agg_error:
+            # Row is graded; summaries catch up on the next recompute
+            print(f"⚠️ AGGREGATE UPDATE FAILED | eval_id={eval_id} | {agg_error}")
+
+    # Probe lease unused (no rows, lost the claim, triaged
+    # locally): let the next caller probe right away
+    if mode == "probe":
+        breaker.release_probe()
+
+# =========================================================
+# METRICS
+# =========================================================
+
+@app.get("/api/metrics")
+def metrics():
+    return {
+        "circuit": breaker.snapshot(),
+        "streaming": stream_stats()
+    }
+
+# =========================================================
+# SCORE STATISTICS (PRECOMPUTED)
+# =========================================================
+
+def _summary(scope, key=None, source=TABLE_NAME):
+    if source not in SOURCES:
+        raise HTTPException(status_code=400, detail=f"Unknown source: {source}")
+
+    query = (
+        supabase
+        .table("score_summary")
+        .select("*")
+        .eq("source", source)
+        .eq("scope", scope)
+    )
+    if key is not None:
+        query = query.eq("scope_key", key)
+    return query
+
+
+@app.get("/api/stats/class")
+def class_stats(source: str = TABLE_NAME):
+    rows = _summary("class", CLASS_KEY, source).limit(1).execute().data or []
+    return {"stats": describe(rows[0]) if rows else None}
+
+
+@app.get("/api/stats/questions")
+def question_stats(limit: int = 50, source: str = TABLE_NAME):
+    rows = _summary("question", source=source).order("n", desc=True).limit(limit).execute().data or []
+    return {"questions": [describe(r) for r in rows]}
+
+
+@app.get("/api/stats/students/{student_id}")
+def student_stats(student_id: str, source: str = TABLE_NAME):
+    rows = _summary("student", student_id, source).limit(1).execute().data or []
+    return {"stats": describe(rows[0]) if rows else None}
 
 # =========================================================
 # BACKGROUND WORKER
@@ -247,7 +371,11 @@ def start_worker():
     def worker():
         while True:
             print("🔍 Checking for pending evaluations...")
-            process_pending_evaluations()
+            try:
+                process_pending_evaluations()
+            except Exception as e:
+                # Keep the daemon alive; rows stay in their status
+                print(f"❌ Evaluation cycle failed → {e}")
             time.sleep(20)
 
     threading.Thread(target=worker, daemon=True).start()
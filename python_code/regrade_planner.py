@@ -0,0 +1,243 @@
+"""
+===========================================================
+RUBRIC-VERSIONED RE-GRADE PLANNER
+-----------------------------------------------------------
+• Finds graded rows (evaluated, or failed on a later
+  attempt) whose grading_fingerprint no longer matches the
+  current rubric / model / prompt
+• Locally triaged rows go stale with the rubric too: their
+  stamp carries the LLM fingerprint it was taken under
+• Estimates API cost and wall-clock time before anything
+  is sent
+• Queues only those rows ('regrade' / 'REGRADE'); the
+  running workers pick them up after live work
+===========================================================
+
+Usage:
+    python regrade_planner.py --init
+    python regrade_planner.py answers
+    python regrade_planner.py answers --queue [--max-rows N]
+    python regrade_planner.py manual_evaluations --workers 2
+"""
+
+import os
+import json
+import argparse
+
+import psycopg2
+from dotenv import load_dotenv
+
+from lexical_scorer import lexical_fingerprint
+
+# =========================================================
+# CONFIG
+# =========================================================
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Rough token / price model; override per provider contract
+CHARS_PER_TOKEN = 4
+OUTPUT_TOKENS_PER_ROW = int(os.getenv("REGRADE_OUTPUT_TOKENS", "150"))
+PRICE_INPUT_PER_M = float(os.getenv("PRICE_INPUT_PER_M", "3.0"))
+PRICE_OUTPUT_PER_M = float(os.getenv("PRICE_OUTPUT_PER_M", "15.0"))
+PRICE_PER_REQUEST = float(os.getenv("PRICE_PER_REQUEST", "0.006"))
+SECONDS_PER_ROW = float(os.getenv("REGRADE_SECONDS_PER_ROW", "5.0"))
+
+QUEUE_PAGE_SIZE = 1000
+
+MIGRATION_SQL = """
+ALTER TABLE answers ADD COLUMN IF NOT EXISTS grading_fingerprint TEXT;
+ALTER TABLE manual_evaluations ADD COLUMN IF NOT EXISTS grading_fingerprint TEXT;
+"""
+
+# =========================================================
+# TARGETS
+# =========================================================
+# Truncation limits mirror each grader's build_request.
+TARGETS = {
+    "answers": {
+        "table": "answers",
+        "id": "id",
+        "status_column": "status",
+        "evaluated": "evaluated",
+        "failed": "failed",
+        "queued": "regrade",
+        "question_chars": 800,
+        "answer_chars": 1500,
+        "extra_set": ", retry_count = 0",
+    },
+    "manual_evaluations": {
+        "table": "manual_evaluations",
+        "id": "eval_id",
+        "status_column": "evaluation_status",
+        "evaluated": "EVALUATED",
+        "failed": "FAILED",
+        "queued": "REGRADE",
+        "question_chars": 1500,
+        "answer_chars": 20000,
+        "extra_set": "",
+    },
+}
+
+def current_grader(target):
+    """
+    (request template, fingerprint) of the grader that owns
+    the table. Imported lazily: each grader module sets up
+    its own clients on import.
+    """
+    if target == "answers":
+        from evaluation_agent_parallel import build_request, FINGERPRINT
+        return build_request("", ""), FINGERPRINT
+
+    from main2 import build_request, GRADING_FINGERPRINT
+    return build_request("", ""), GRADING_FINGERPRINT
+
+# =========================================================
+# PLAN
+# =========================================================
+def _stale_clause(cfg):
+    # Failed rows count when they still hold an earlier grade
+    return f"""
+        {cfg['status_column']} = ANY(%s)
+        AND evaluated_at IS NOT NULL
+        AND NOT (coalesce(grading_fingerprint, '') = ANY(%s))
+    """
+
+def fresh_fingerprints(target):
+    """
+    Stamps that count as current for a table: the live grader's,
+    for answers also the bulk grader's (BULK_MODEL), and the
+    lexical form of each.
+    """
+    _, fingerprint = current_grader(target)
+    graders = [fingerprint]
+    if target == "answers":
+        from bulk_grading import BULK_FINGERPRINT
+        graders.append(BULK_FINGERPRINT)
+
+    fresh = []
+    for f in dict.fromkeys(graders):
+        fresh += [f, lexical_fingerprint(f)]
+    return fresh
+
+def _stale_params(cfg, fresh):
+    return [cfg["evaluated"], cfg["failed"]], fresh
+
+def plan_regrade(target, workers=1):
+    cfg = TARGETS[target]
+    template, fingerprint = current_grader(target)
+    fresh = fresh_fingerprints(target)
+
+    with psycopg2.connect(DATABASE_URL) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT grading_fingerprint,
+                       count(*),
+                       coalesce(sum(
+                           least(length(coalesce(question, '')), %s)
+                           + least(length(coalesce(answer, '')), %s)
+                       ), 0)
+                FROM {cfg['table']}
+                WHERE {_stale_clause(cfg)}
+                GROUP BY grading_fingerprint;
+                """,
+                (cfg["question_chars"], cfg["answer_chars"], *_stale_params(cfg, fresh))
+            )
+            groups = cur.fetchall()
+
+    rows = sum(g[1] for g in groups)
+    content_chars = sum(g[2] for g in groups)
+    template_chars = sum(len(m["content"]) for m in template["messages"])
+
+    input_tokens = (rows * template_chars + content_chars) / CHARS_PER_TOKEN
+    output_tokens = rows * min(OUTPUT_TOKENS_PER_ROW, template["max_tokens"])
+    cost = (
+        input_tokens / 1e6 * PRICE_INPUT_PER_M
+        + output_tokens / 1e6 * PRICE_OUTPUT_PER_M
+        + rows * PRICE_PER_REQUEST
+    )
+
+    return {
+        "target": target,
+        "current_fingerprint": fingerprint,
+        "fresh_fingerprints": fresh,
+        "stale_rows": rows,
+        "stale_by_fingerprint": {g[0] or "unstamped": g[1] for g in groups},
+        "est_input_tokens": int(input_tokens),
+        "est_output_tokens": int(output_tokens),
+        "est_cost_usd": round(cost, 2),
+        "workers": workers,
+        "est_hours": round(rows * SECONDS_PER_ROW / max(workers, 1) / 3600, 2),
+    }
+
+# =========================================================
+# QUEUE
+# =========================================================
+def queue_regrade(target, max_rows=None):
+    """
+    Flip stale graded rows to the re-grade status in pages.
+    Old scores stay in place until the worker replaces them.
+    """
+    cfg = TARGETS[target]
+    fresh = fresh_fingerprints(target)
+
+    queued = 0
+    while max_rows is None or queued < max_rows:
+        page = QUEUE_PAGE_SIZE if max_rows is None else min(QUEUE_PAGE_SIZE, max_rows - queued)
+
+        with psycopg2.connect(DATABASE_URL) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    UPDATE {cfg['table']}
+                    SET {cfg['status_column']} = %s{cfg['extra_set']}
+                    WHERE {cfg['id']} IN (
+                        SELECT {cfg['id']}
+                        FROM {cfg['table']}
+                        WHERE {_stale_clause(cfg)}
+                        ORDER BY {cfg['id']}
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    );
+                    """,
+                    (cfg["queued"], *_stale_params(cfg, fresh), page)
+                )
+                count = cur.rowcount
+
+        if not count:
+            break
+        queued += count
+        print(f"📝 Queued {queued} rows for re-grade")
+
+    return queued
+
+def init_schema():
+    with psycopg2.connect(DATABASE_URL) as conn:
+        with conn.cursor() as cur:
+            cur.execute(MIGRATION_SQL)
+
+    print("✅ grading_fingerprint columns ready")
+
+# =========================================================
+# ENTRY POINT
+# =========================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan and queue rubric re-grades")
+    parser.add_argument("target", nargs="?", choices=sorted(TARGETS))
+    parser.add_argument("--init", action="store_true", help="add grading_fingerprint columns")
+    parser.add_argument("--workers", type=int, default=1, help="workers sharing the queue")
+    parser.add_argument("--queue", action="store_true", help="queue the stale rows after planning")
+    parser.add_argument("--max-rows", type=int, help="queue at most N rows")
+    args = parser.parse_args()
+
+    if args.init:
+        init_schema()
+
+    if args.target:
+        print(json.dumps(plan_regrade(args.target, args.workers), indent=2))
+        if args.queue:
+            queue_regrade(args.target, args.max_rows)
+    elif not args.init:
+        parser.print_help()
@@ -0,0 +1,342 @@
+"""
+===========================================================
+SCORE AGGREGATES
+-----------------------------------------------------------
+• Summary table with per-class / per-question / per-student
+  running count, sum, sum of squares and 0–10 histogram
+• Incremental update in the same transaction as the score
+  write (psycopg2) or through an RPC (Supabase)
+• Vectorized batch recompute for backfills
+• O(1) reads for the scores dashboard
+===========================================================
+
+Usage:
+    python score_aggregates.py --init
+    python score_aggregates.py --recompute answers
+    python score_aggregates.py --recompute manual_evaluations
+"""
+
+import os
+import re
+import math
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+HIST_BUCKETS = 11  # integer scores 0..10
+CLASS_KEY = "all"
+
+# =========================================================
+# SCORE SOURCES
+# =========================================================
+# Every table that stores graded answers, and the columns the
+# aggregates are built from. answers has no fixed student column;
+# set ANSWERS_STUDENT_COLUMN to get per-student summaries for it.
+SOURCES = {
+    "answers": {
+        "table": "answers",
+        "score": "total_score",
+        "student": os.getenv("ANSWERS_STUDENT_COLUMN"),
+        "question": "question",
+    },
+    "manual_evaluations": {
+        "table": "manual_evaluations",
+        "score": "score",
+        "student": "auth_user_id",
+        "question": "question",
+    },
+}
+
+# =========================================================
+# SCHEMA
+# =========================================================
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS score_summary (
+    source      TEXT NOT NULL,
+    scope       TEXT NOT NULL,          -- 'class' | 'question' | 'student'
+    scope_key   TEXT NOT NULL,
+    label       TEXT,
+    n           INTEGER NOT NULL DEFAULT 0,
+    total       DOUBLE PRECISION NOT NULL DEFAULT 0,
+    total_sq    DOUBLE PRECISION NOT NULL DEFAULT 0,
+    hist        INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[11]),
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (source, scope, scope_key)
+);
+
+CREATE OR REPLACE FUNCTION bump_score_summary(
+    p_source TEXT, p_scope TEXT, p_key TEXT, p_label TEXT,
+    p_score DOUBLE PRECISION, p_delta INTEGER
+) RETURNS VOID LANGUAGE plpgsql AS $$
+DECLARE
+    b INTEGER := least(greatest(round(p_score)::INTEGER, 0), 10) + 1;
+BEGIN
+    INSERT INTO score_summary (source, scope, scope_key, label)
+    VALUES (p_source, p_scope, p_key, p_label)
+    ON CONFLICT DO NOTHING;
+
+    UPDATE score_summary
+    SET n = n + p_delta,
+        total = total + p_delta * p_score,
+        total_sq = total_sq + p_delta * p_score * p_score,
+        hist[b] = hist[b] + p_delta,
+        updated_at = now()
+    WHERE source = p_source AND scope = p_scope AND scope_key = p_key;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION record_score(
+    p_source TEXT, p_student TEXT, p_question_key TEXT, p_question TEXT,
+    p_score DOUBLE PRECISION, p_delta INTEGER DEFAULT 1
+) RETURNS VOID LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM bump_score_summary(p_source, 'class', 'all', NULL, p_score, p_delta);
+    PERFORM bump_score_summary(p_source, 'question', p_question_key, p_question, p_score, p_delta);
+    IF p_student IS NOT NULL THEN
+        PERFORM bump_score_summary(p_source, 'student', p_student, NULL, p_score, p_delta);
+    END IF;
+END;
+$$;
+"""
+
+RECORD_SCORE_SQL = """
+    SELECT record_score(
+        %(p_source)s, %(p_student)s, %(p_question_key)s, %(p_question)s,
+        %(p_score)s, %(p_delta)s
+    );
+"""
+
+# =========================================================
+# KEYS
+# =========================================================
+def student_column(source, alias=None):
+    """
+    SQL expression for a source's student key, or NULL (no
+    per-student summaries, with a warning) when none is set.
+    """
+    column = SOURCES[source]["student"]
+    if not column:
+        print(f"⚠️ No student column configured for {source}; per-student summaries are skipped")
+        return "NULL"
+    return f"{alias}.{column}" if alias else column
+
+
+def question_key(question):
+    """
+    Stable key for a free-text question: md5 of the
+    whitespace-collapsed, lower-cased text.
+    """
+    normalized = re.sub(r"\s+", " ", str(question or "")).strip().lower()
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()
+
+
+def _score_params(source, question, student, score, delta):
+    return {
+        "p_source": source,
+        "p_student": None if student is None else str(student),
+        "p_question_key": question_key(question),
+        "p_question": str(question or "")[:200],
+        "p_score": float(score),
+        "p_delta": int(delta),
+    }
+
+# =========================================================
+# INCREMENTAL UPDATES
+# =========================================================
+def record_score(cur, source, question, student, score, delta=1):
+    """
+    Apply one score to the summaries using an open psycopg2
+    cursor, so it commits or rolls back with the score write.
+    Use delta=-1 to take a previously recorded score back out.
+    """
+    cur.execute(RECORD_SCORE_SQL, _score_params(source, question, student, score, delta))
+
+
+def record_scores(cur, items):
+    """
+    Bulk form of record_score for (source, question, student,
+    score, delta) tuples, sent in pages to save round trips.
+    """
+    from psycopg2.extras import execute_batch
+
+    execute_batch(
+        cur, RECORD_SCORE_SQL,
+        [_score_params(*item) for item in items],
+        page_size=200
+    )
+
+
+def record_score_rpc(supabase, source, question, student, score, delta=1):
+    """
+    Same as record_score, through the Supabase RPC endpoint.
+    """
+    supabase.rpc(
+        "record_score",
+        _score_params(source, question, student, score, delta)
+    ).execute()
+
+# =========================================================
+# BATCH RECOMPUTE (VECTORIZED)
+# =========================================================
+def compute_summaries(df, source):
+    """
+    Build score_summary rows from a DataFrame with columns
+    student, question, score. Returns a DataFrame matching the
+    score_summary columns (without updated_at).
+    """
+    columns = ["source", "scope", "scope_key", "label", "n", "total", "total_sq", "hist"]
+
+    df = df.dropna(subset=["score"]).copy()
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    df["score"] = df["score"].astype(float)
+    df["score_sq"] = df["score"] ** 2
+    df["bucket"] = np.clip(np.rint(df["score"].to_numpy()), 0, HIST_BUCKETS - 1).astype(int)
+    df["class_key"] = CLASS_KEY
+    df["question_key"] = df["question"].map(question_key)
+    df["student"] = df["student"].where(df["student"].isna(), df["student"].astype(str))
+
+    frames = []
+    for scope, key_col in [("class", "class_key"), ("question", "question_key"), ("student", "student")]:
+        scoped = df.dropna(subset=[key_col])
+        if scoped.empty:
+            continue
+
+        grouped = scoped.groupby(key_col)
+        agg = grouped.agg(
+            n=("score", "size"),
+            total=("score", "sum"),
+            total_sq=("score_sq", "sum"),
+        )
+        hist = (
+            pd.crosstab(scoped[key_col], scoped["bucket"])
+            .reindex(columns=range(HIST_BUCKETS), fill_value=0)
+        )
+        agg["hist"] = hist.loc[agg.index].to_numpy().tolist()
+
+        if scope == "question":
+            agg["label"] = grouped["question"].first().astype(str).str[:200]
+        else:
+            agg["label"] = None
+
+        agg = agg.reset_index().rename(columns={key_col: "scope_key"})
+        agg["source"] = source
+        agg["scope"] = scope
+        frames.append(agg[columns])
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def recompute(source):
+    """
+    Rebuild all summaries for one source from the raw rows.
+    Runs in a single transaction, so readers never see a
+    half-built table. score_summary is locked against writers
+    first: incremental updates committed by live workers during
+    the rebuild would otherwise be deleted with the old rows
+    while missing from the snapshot. Those workers wait for the
+    rebuild and then apply their update on top of it.
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+
+    cfg = SOURCES[source]
+    # A row counts once it has been graded, including while it
+    # waits for a re-grade; this is the rule the incremental
+    # updates follow too.
+    query = f"""
+        SELECT {student_column(source)}, {cfg['question']}, {cfg['score']}
+        FROM {cfg['table']}
+        WHERE evaluated_at IS NOT NULL
+          AND {cfg['score']} IS NOT NULL;
+    """
+
+    with psycopg2.connect(DATABASE_URL) as conn:
+        with conn.cursor() as cur:
+            # Blocks record_score (row writes) but not readers
+            cur.execute("LOCK TABLE score_summary IN SHARE ROW EXCLUSIVE MODE;")
+            cur.execute(query)
+            df = pd.DataFrame(cur.fetchall(), columns=["student", "question", "score"])
+
+            summaries = compute_summaries(df, source)
+
+            cur.execute("DELETE FROM score_summary WHERE source = %s;", (source,))
+            execute_values(
+                cur,
+                """
+                INSERT INTO score_summary
+                    (source, scope, scope_key, label, n, total, total_sq, hist)
+                VALUES %s
+                """,
+                [
+                    (
+                        r.source, r.scope, r.scope_key, r.label,
+                        int(r.n), float(r.total), float(r.total_sq),
+                        [int(h) for h in r.hist],
+                    )
+                    for r in summaries.itertuples(index=False)
+                ],
+            )
+
+    print(f"📊 Recomputed {len(summaries)} summaries from {len(df)} rows ({source})")
+    return len(summaries)
+
+
+def init_schema():
+    import psycopg2
+
+    with psycopg2.connect(DATABASE_URL) as conn:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA_SQL)
+
+    print("✅ score_summary schema ready")
+
+# =========================================================
+# READS
+# =========================================================
+def describe(row):
+    """
+    Turn a score_summary row into dashboard statistics.
+    """
+    if not row:
+        return None
+
+    n = row["n"]
+    total = row["total"]
+    mean = total / n if n else 0.0
+    variance = max(row["total_sq"] / n - mean * mean, 0.0) if n else 0.0
+
+    return {
+        "scope": row["scope"],
+        "key": row["scope_key"],
+        "label": row.get("label"),
+        "count": n,
+        "total": round(total, 2),
+        "average": round(mean, 2),
+        "std_dev": round(math.sqrt(variance), 2),
+        "distribution": {str(i): c for i, c in enumerate(row["hist"])},
+    }
+
+# =========================================================
+# ENTRY POINT
+# =========================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain score_summary")
+    parser.add_argument("--init", action="store_true", help="create table and functions")
+    parser.add_argument("--recompute", choices=sorted(SOURCES), help="rebuild summaries for a source")
+    args = parser.parse_args()
+
+    if args.init:
+        init_schema()
+    if args.recompute:
+        recompute(args.recompute)
+    if not (args.init or args.recompute):
+        parser.print_help()
@@ -0,0 +1,165 @@
+"""
+===========================================================
+STREAMED GRADING CALLS
+-----------------------------------------------------------
+• Consumes chat completions as a stream
+• Incremental scanner finds the first complete top-level
+  JSON object as chunks arrive
+• Closes the stream as soon as that object parses and
+  passes the grader's check, so trailing text is never
+  generated
+• Records time-to-first-token and time-to-valid-JSON per
+  call, plus running totals
+===========================================================
+"""
+
+import json
+import time
+import threading
+
+# =========================================================
+# INCREMENTAL JSON SCANNER
+# =========================================================
+class JSONObjectScanner:
+    """
+    Feed text chunks; feed() returns the text of every
+    top-level {...} object completed by that chunk. Braces
+    inside strings and escaped quotes are handled, so it is
+    safe on feedback text containing '{' or '}'.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text):
+        completed = []
+        for ch in text:
+            if self.depth == 0:
+                if ch == "{":
+                    self.depth = 1
+                    self.buffer = [ch]
+                continue
+
+            self.buffer.append(ch)
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    completed.append("".join(self.buffer))
+                    self.buffer = []
+
+        return completed
+
+# =========================================================
+# METRICS
+# =========================================================
+_lock = threading.Lock()
+_totals = {
+    "calls": 0,
+    "valid": 0,
+    "early_stops": 0,
+    "ttft_sum": 0.0,
+    "ttvj_sum": 0.0,
+    "output_chars": 0,
+}
+
+def _record(metrics):
+    with _lock:
+        _totals["calls"] += 1
+        _totals["output_chars"] += metrics["output_chars"]
+        if metrics["ttft"] is not None:
+            _totals["ttft_sum"] += metrics["ttft"]
+        if metrics["ttvj"] is not None:
+            _totals["valid"] += 1
+            _totals["ttvj_sum"] += metrics["ttvj"]
+        if metrics["early_stop"]:
+            _totals["early_stops"] += 1
+
+def stream_stats():
+    """
+    Running averages for all streamed calls in this process.
+    """
+    with _lock:
+        t = dict(_totals)
+
+    calls = t["calls"]
+    return {
+        "calls": calls,
+        "valid_json": t["valid"],
+        "early_stops": t["early_stops"],
+        "avg_ttft_seconds": round(t["ttft_sum"] / calls, 3) if calls else None,
+        "avg_ttvj_seconds": round(t["ttvj_sum"] / t["valid"], 3) if t["valid"] else None,
+        # ~4 chars per token; usage is not reported once a stream is cut short
+        "est_output_tokens": t["output_chars"] // 4,
+    }
+
+# =========================================================
+# STREAMED CALL
+# =========================================================
+def stream_json(client, request, validate=None):
+    """
+    Run one chat completion request as a stream and return
+    (parsed_object, metrics) for the first JSON object that
+    parses and passes validate(obj) (truthy = accept).
+
+    Raises ValueError if the stream ends without one.
+    """
+    start = time.monotonic()
+    metrics = {"ttft": None, "ttvj": None, "output_chars": 0, "early_stop": False}
+    scanner = JSONObjectScanner()
+    result = None
+
+    stream = client.chat.completions.create(**request, stream=True)
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content or ""
+            if not text:
+                continue
+
+            if metrics["ttft"] is None:
+                metrics["ttft"] = round(time.monotonic() - start, 3)
+            metrics["output_chars"] += len(text)
+
+            for candidate in scanner.feed(text):
+                try:
+                    obj = json.loads(candidate)
+                except json.JSONDecodeError:
+                    continue
+                if validate is None or validate(obj):
+                    result = obj
+                    break
+
+            if result is not None:
+                metrics["ttvj"] = round(time.monotonic() - start, 3)
+                metrics["early_stop"] = chunk.choices[0].finish_reason is None
+                break
+    finally:
+        # Closing the HTTP response stops generation (and billing)
+        stream.close()
+        _record(metrics)
+
+    print(
+        f"⏱ ttft={metrics['ttft']}s ttvj={metrics['ttvj']}s "
+        f"chars={metrics['output_chars']} early_stop={metrics['early_stop']}"
+    )
+
+    if result is None:
+        raise ValueError("AI response does not contain valid JSON")
+
+    return result, metrics
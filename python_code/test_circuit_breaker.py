@@ -0,0 +1,143 @@
+"""
+State-machine tests for the provider circuit breaker against
+the in-memory store (run: python -m pytest). The clock is
+patched, so cooldowns and leases need no waiting.
+"""
+
+import httpx
+import openai
+import pytest
+
+import circuit_breaker as cb
+from circuit_breaker import CircuitBreaker, MemoryStore, ProviderUnavailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cb.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("test", MemoryStore())
+
+
+def outage():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://provider"))
+
+
+def fail(breaker):
+    def down():
+        raise outage()
+    with pytest.raises(ProviderUnavailable):
+        breaker.call(down)
+
+
+def trip(breaker):
+    for _ in range(cb.MIN_CALLS):
+        fail(breaker)
+
+
+def test_closed_counts_calls(breaker):
+    assert breaker.acquire() == "closed"
+    assert breaker.call(lambda: 42) == 42
+    assert breaker.snapshot()["window_calls"] == 1
+
+
+def test_error_rate_opens_circuit(breaker):
+    trip(breaker)
+    snap = breaker.snapshot()
+    assert snap["state"] == "open"
+    assert snap["trips"] == 1
+    assert breaker.acquire() is None
+
+
+def test_non_outage_error_counts_as_success(breaker):
+    def bad_json():
+        raise ValueError("no JSON")
+    for _ in range(cb.MIN_CALLS):
+        with pytest.raises(ValueError):
+            breaker.call(bad_json)
+    assert breaker.snapshot()["state"] == "closed"
+
+
+def test_mid_stream_api_error_is_an_outage(breaker):
+    def stream_error():
+        raise openai.APIError("overloaded", httpx.Request("POST", "https://provider"), body=None)
+    with pytest.raises(ProviderUnavailable):
+        breaker.call(stream_error)
+    assert breaker.snapshot()["window_failures"] == 1
+
+
+def test_cooldown_leads_to_single_probe(breaker, clock):
+    trip(breaker)
+    clock.now += cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() == "probe"
+    assert breaker.snapshot()["state"] == "half_open"
+    # Lease held: nobody else probes
+    assert breaker.acquire() is None
+
+
+def test_successful_probe_closes_circuit(breaker, clock):
+    trip(breaker)
+    clock.now += cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() == "probe"
+    breaker.call(lambda: "ok")
+    snap = breaker.snapshot()
+    assert snap["state"] == "closed"
+    assert snap["cooldown_seconds"] == cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() == "closed"
+
+
+def test_failed_probe_reopens_with_longer_cooldown(breaker, clock):
+    trip(breaker)
+    clock.now += cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() == "probe"
+    fail(breaker)
+    snap = breaker.snapshot()
+    assert snap["state"] == "open"
+    assert snap["cooldown_seconds"] == 2 * cb.BASE_COOLDOWN_SECONDS
+    clock.now += cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() is None
+
+
+def test_released_probe_lets_next_caller_probe(breaker, clock):
+    trip(breaker)
+    clock.now += cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() == "probe"
+    breaker.release_probe()
+    assert breaker.acquire() == "probe"
+
+
+def test_probe_lease_expires(breaker, clock):
+    trip(breaker)
+    clock.now += cb.BASE_COOLDOWN_SECONDS
+    assert breaker.acquire() == "probe"
+    clock.now += cb.PROBE_LEASE_SECONDS
+    assert breaker.acquire() == "probe"
+
+
+def test_release_probe_is_noop_when_closed(breaker):
+    breaker.release_probe()
+    assert breaker.acquire() == "closed"
+
+
+def test_store_errors_fail_open(clock):
+    class BrokenStore:
+        def transaction(self):
+            raise RuntimeError('relation "provider_circuit" does not exist')
+
+    breaker = CircuitBreaker("test", BrokenStore())
+    assert breaker.acquire() == "closed"
+    assert breaker.call(lambda: 7) == 7
+    assert breaker.snapshot()["store_fallback"] is True
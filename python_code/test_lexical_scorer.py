@@ -0,0 +1,94 @@
+"""
+Behaviour tests for the local lexical triage (run: python -m pytest).
+Fixtures are held-out style rows: question, reference answer,
+and student answers whose correct handling is known.
+"""
+
+import pytest
+
+from lexical_scorer import triage, score_rows
+
+THRESHOLD = 0.8
+
+QUESTION = "What is photosynthesis?"
+REFERENCE = (
+    "Photosynthesis is the process by which green plants use sunlight, "
+    "water and carbon dioxide to produce glucose and release oxygen. "
+    "It takes place in the chloroplasts, which contain chlorophyll."
+)
+
+VERBATIM = REFERENCE
+PARAPHRASE = (
+    "Green leaves trap light energy with chlorophyll and turn carbon "
+    "dioxide plus water into sugar, giving out oxygen as a by-product."
+)
+UNRELATED = (
+    "Cricket is played between two teams of eleven players on a field "
+    "with a pitch, wickets, bats and a ball, and the team scoring more "
+    "runs wins the match."
+)
+
+# Correct answers that share no words with their question
+CORRECT_NO_OVERLAP = [
+    ("What is photosynthesis?",
+     "Green plants use sunlight, water and carbon dioxide to make glucose and release oxygen."),
+    ("State Newton's third law.",
+     "Every action has an equal and opposite reaction acting on different bodies."),
+    ("Why did the French Revolution begin?",
+     "Heavy taxes on peasants, bread shortages, royal debt and Enlightenment ideas led people to revolt in 1789."),
+]
+
+
+def rows(*answers, reference=REFERENCE):
+    return [
+        {"question": QUESTION, "answer": a, "reference_answer": reference}
+        for a in answers
+    ]
+
+
+def test_verbatim_copy_of_reference_is_triaged():
+    [result] = triage(rows(VERBATIM), threshold=THRESHOLD)
+    assert result is not None
+    assert result["reason"] == "verbatim"
+    assert result["score"] >= 9
+
+
+@pytest.mark.parametrize("answer", [PARAPHRASE, CORRECT_NO_OVERLAP[0][1]])
+def test_correct_paraphrase_goes_to_llm(answer):
+    assert triage(rows(answer), threshold=THRESHOLD) == [None]
+
+
+@pytest.mark.parametrize("blank", ["", "   ", None, float("nan")])
+def test_blank_answer_is_triaged(blank):
+    [result] = triage(rows(blank), threshold=THRESHOLD)
+    assert result == {"score": 0, "confidence": 1.0, "reason": "blank"}
+
+
+def test_unrelated_answer_is_triaged_with_reference():
+    [result] = triage(rows(UNRELATED), threshold=THRESHOLD)
+    assert result is not None
+    assert result["reason"] == "off_topic"
+    assert result["score"] == 0
+
+
+def test_unrelated_answer_goes_to_llm_without_reference():
+    assert triage(rows(UNRELATED, reference=None), threshold=THRESHOLD) == [None]
+
+
+@pytest.mark.parametrize("question,answer", CORRECT_NO_OVERLAP)
+def test_correct_answer_without_question_overlap_is_never_zeroed(question, answer):
+    [result] = triage([{"question": question, "answer": answer}], threshold=THRESHOLD)
+    assert result is None
+
+
+def test_triage_is_disabled_without_threshold(monkeypatch):
+    import lexical_scorer
+
+    monkeypatch.setattr(lexical_scorer, "CONFIDENCE_THRESHOLD", None)
+    assert triage(rows(VERBATIM, "")) == [None, None]
+
+
+def test_score_rows_aligned_across_questions():
+    mixed = rows(VERBATIM) + [{"question": "Define force.", "answer": ""}] + rows(UNRELATED)
+    results = score_rows(mixed)
+    assert [r["reason"] for r in results] == ["verbatim", "blank", "off_topic"]
@@ -0,0 +1,63 @@
+"""
+Tests for the incremental JSON scanner (run: python -m pytest).
+It decides where every streamed grade is cut, so chunk
+boundaries, strings and trailing text all matter.
+"""
+
+import json
+
+import pytest
+
+from stream_grading import JSONObjectScanner
+
+
+def feed_all(chunks):
+    scanner = JSONObjectScanner()
+    found = []
+    for chunk in chunks:
+        found.extend(scanner.feed(chunk))
+    return found
+
+
+def test_single_object_in_one_chunk():
+    assert feed_all(['{"score": 7}']) == ['{"score": 7}']
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8])
+def test_object_split_across_chunks(size):
+    text = '{"total_score": 6, "feedback": "Clear and {mostly} correct"}'
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    assert feed_all(chunks) == [text]
+
+
+def test_braces_inside_strings_are_ignored():
+    text = '{"feedback": "use } and { freely", "score": 4}'
+    [found] = feed_all([text])
+    assert json.loads(found) == {"feedback": "use } and { freely", "score": 4}
+
+
+def test_escaped_quotes_inside_strings():
+    text = r'{"feedback": "he said \"see {x}\" then \\", "score": 5}'
+    [found] = feed_all([text[:20], text[20:]])
+    assert json.loads(found)["score"] == 5
+
+
+def test_escape_split_at_chunk_boundary():
+    text = r'{"feedback": "a \"}\" b", "score": 3}'
+    cut = text.index("\\") + 1
+    [found] = feed_all([text[:cut], text[cut:]])
+    assert json.loads(found)["feedback"] == 'a "}" b'
+
+
+def test_preamble_and_trailing_text():
+    chunks = ["Sure! Here is the grade:\n", '{"score": 8, "nested": {"a": 1}}', "\nHope this helps {"]
+    assert feed_all(chunks) == ['{"score": 8, "nested": {"a": 1}}']
+
+
+def test_several_objects_are_returned_in_order():
+    text = 'Example: {} then {"score": 2}'
+    assert feed_all([text]) == ["{}", '{"score": 2}']
+
+
+def test_unfinished_object_yields_nothing():
+    assert feed_all(['{"score": 9, "feedback": "cut off']) == []